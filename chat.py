@@ -1,16 +1,85 @@
 import gradio as gr
 import logging
-import re
 import os
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import html
 from urllib.parse import unquote
-from thefuzz import process
+from rapidfuzz import process, fuzz, utils
 
 logger = logging.getLogger(__name__)
 
+# Same replacements as html.escape(quote=True), applied with a single str.translate
+_HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+# Anchor link that scrolls to a source card: (card index, card index, escaped link text)
+_ANCHOR_LINK_TEMPLATE = '<a href="#source-card-%d" onclick="document.getElementById(\'source-card-%d\').scrollIntoView({behavior: \'smooth\'}); return false;">%s</a>'
+# Source card: (card index, escaped filename, escaped url)
+_SOURCE_CARD_TEMPLATE = '<div class="source-card" id="source-card-%d"><div class="card-icon">📄</div><div class="card-title">%s</div><a href="%s" class="card-link" target="_blank">Download</a></div>'
+
+# Threshold of 60% similarity for fuzzy matches
+_SCORE_CUTOFF = 60
+# Maximum number of fuzzy match results kept for the cached scan
+_MATCH_CACHE_SIZE = 512
+# Maximum number of decoded link filenames kept by _unquote
+_UNQUOTE_CACHE_SIZE = 4096
+# Rebuild the streamed message for the UI every this many chunks (or at whitespace)
+_STREAM_REFRESH_CHUNKS = 8
+# Walk top-level subdirectories in parallel threads once there are at least this many
+_PARALLEL_SCAN_MIN_DIRS = 4
+
+# Scanned files as parallel lists (one entry per file at the same index in each list)
+ScannedFiles = namedtuple("ScannedFiles", ["paths", "names_without_ext", "full_names"])
+
+# Snapshot of one scan together with everything derived from it; "matches" memoizes
+# fuzzy match results against this scan
+_FileScan = namedtuple("_FileScan", ["directory", "mtime", "files", "names", "names_index", "matches"])
+
+# Last scan of the files directory, reused until the directory's mtime changes.
+# Scans run in worker threads, so a new snapshot is only ever published whole.
+_file_scan = None
+
+def _names_for_matching(file_list):
+    """Build the pre-processed names used as fuzzy matching choices"""
+    return [utils.default_process(name) for name in file_list.names_without_ext]
+
+def _build_names_index(file_list):
+    """Map exact and lowercased names without extension to file paths (first file wins)"""
+    exact = {}
+    lowered = {}
+    for name, path in zip(file_list.names_without_ext, file_list.paths):
+        exact.setdefault(name, path)
+        lowered.setdefault(name.lower(), path)
+    return exact, lowered
+
+def _scan_entries(directory, files):
+    """Add the files of one directory to files using os.scandir and return its subdirectories"""
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # DirEntry answers is_dir/is_file from the directory listing without an extra stat
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                # Store both the relative path and filename without extension for matching
+                name = entry.name
+                files.paths.append(entry.path)
+                files.names_without_ext.append(name.rpartition('.')[0] or name)
+                files.full_names.append(name)
+    return subdirs
+
+def _walk_directory(directory):
+    """Recursively collect file information under a directory"""
+    files = ScannedFiles([], [], [])
+    stack = [directory]
+    while stack:
+        stack.extend(_scan_entries(stack.pop(), files))
+    return files
+
 def scan_files_directory(files_directory="public/files/"):
     """Scan the files directory and return file information for fuzzy matching"""
+    global _file_scan
     try:
         # Get absolute path to the files directory
         files_dir = Path(files_directory)
@@ -19,79 +88,192 @@ def scan_files_directory(files_directory="public/files/"):
         if not files_dir.exists():
             logger.warning(f"Files directory {files_directory} does not exist")
             return None
+        
+        # Reuse the previous scan while the directory is unchanged (top-level mtime only)
+        mtime = files_dir.stat().st_mtime_ns
+        file_scan = _file_scan
+        if file_scan and file_scan.directory == files_directory and file_scan.mtime == mtime:
+            return file_scan.files
             
-        all_files = []
-        for file_path in files_dir.rglob("*"):
-            if file_path.is_file():
-                # Store both the relative path and filename without extension for matching
-                relative_path = file_path.relative_to(Path("."))
-                filename_without_ext = file_path.stem
-                all_files.append({
-                    'path': str(relative_path),
-                    'name_without_ext': filename_without_ext,
-                    'full_name': file_path.name
-                })
+        # Walk top-level subdirectories in parallel for larger trees; os.scandir releases the GIL
+        all_files = ScannedFiles([], [], [])
+        top_level_dirs = _scan_entries(os.path.normpath(files_directory), all_files)
+        if len(top_level_dirs) >= _PARALLEL_SCAN_MIN_DIRS:
+            with ThreadPoolExecutor(max_workers=min(len(top_level_dirs), os.cpu_count() or 1)) as executor:
+                subtrees = list(executor.map(_walk_directory, top_level_dirs))
+        else:
+            subtrees = [_walk_directory(directory) for directory in top_level_dirs]
+        for subtree_files in subtrees:
+            for column, subtree_column in zip(all_files, subtree_files):
+                column.extend(subtree_column)
         
-        if not all_files:
+        if not all_files.paths:
             logger.info(f"No files found in {files_directory}")
-            return None
+            all_files = None
         
+        # Matches against the previous scan are stale now, so the new snapshot starts empty
+        _file_scan = _FileScan(
+            directory=files_directory,
+            mtime=mtime,
+            files=all_files,
+            names=_names_for_matching(all_files) if all_files else None,
+            names_index=_build_names_index(all_files) if all_files else None,
+            matches={},
+        )
         return all_files
             
     except Exception as e:
         logger.error(f"Error scanning files directory: {e}")
         return None
 
-def find_best_match(filename, file_list):
-    """Find the best matching file from a pre-scanned file list using fuzzy matching"""
+def _match_files(target_names, file_list, names_for_matching):
+    """Fuzzy match target names against pre-processed names in one batch and return the file paths"""
+    # Score every target against every name at once; scores below the cutoff come back as 0
+    scores = process.cdist(
+        [utils.default_process(target_name) for target_name in target_names],
+        names_for_matching,
+        scorer=fuzz.WRatio,
+        processor=None,  # Names are already processed
+        score_cutoff=_SCORE_CUTOFF,
+        workers=-1,
+    )
+    
+    matched_paths = []
+    for target_name, row, best_index in zip(target_names, scores, scores.argmax(axis=1)):
+        if row[best_index] >= _SCORE_CUTOFF:
+            # Find the corresponding file info
+            matched_path = file_list.paths[best_index]
+            logger.info(f"Found fuzzy match for '{target_name}': {matched_path} (score: {row[best_index]:.1f})")
+            matched_paths.append(matched_path)
+        else:
+            logger.info(f"No good fuzzy match found for '{target_name}'")
+            matched_paths.append(None)
+    return matched_paths
+
+def find_best_matches(filenames, file_list):
+    """Find the best matching file for each filename from a pre-scanned file list using fuzzy matching"""
     try:
         if not file_list:
-            return None
+            return [None] * len(filenames)
         
-        # Remove extension from the target filename for comparison
-        target_name = Path(filename).stem
+        # Remove extensions from the target filenames for comparison
+        target_names = [Path(filename).stem for filename in filenames]
         
-        # Create list of names without extensions for fuzzy matching
-        names_for_matching = [f['name_without_ext'] for f in file_list]
+        # Read the cached scan once; a scan finishing in another thread can't mix two scans here
+        file_scan = _file_scan
+        is_cached_scan = file_scan is not None and file_list is file_scan.files
+        exact, lowered = file_scan.names_index if is_cached_scan else _build_names_index(file_list)
+        match_cache = file_scan.matches if is_cached_scan else {}
         
-        # Find the best match using fuzzy matching
-        best_match = process.extractOne(target_name, names_for_matching)
+        matches = {}
+        for target_name in target_names:
+            if target_name in matches:
+                continue
+            # Exact (then case-insensitive) name hits skip fuzzy matching entirely
+            matched_path = exact.get(target_name) or lowered.get(target_name.lower())
+            if matched_path:
+                logger.info(f"Found exact match for '{target_name}': {matched_path}")
+                matches[target_name] = matched_path
+            elif target_name in match_cache:
+                matches[target_name] = match_cache[target_name]
         
-        if best_match and best_match[1] > 60:  # Threshold of 60% similarity
-            # Find the corresponding file info
-            matched_index = names_for_matching.index(best_match[0])
-            matched_file = file_list[matched_index]
-            logger.info(f"Found fuzzy match for '{filename}': {matched_file['path']} (score: {best_match[1]})")
-            return matched_file['path']
-        else:
-            logger.info(f"No good fuzzy match found for '{filename}' (best score: {best_match[1] if best_match else 'N/A'})")
-            return None
+        # Fuzzy match everything else in a single batch
+        pending = [target_name for target_name in dict.fromkeys(target_names) if target_name not in matches]
+        if pending:
+            names_for_matching = file_scan.names if is_cached_scan else _names_for_matching(file_list)
+            fuzzy_matches = dict(zip(pending, _match_files(pending, file_list, names_for_matching)))
+            matches.update(fuzzy_matches)
+            if is_cached_scan:
+                if len(match_cache) + len(fuzzy_matches) > _MATCH_CACHE_SIZE:
+                    match_cache.clear()
+                match_cache.update(fuzzy_matches)
+        
+        return [matches[target_name] for target_name in target_names]
             
     except Exception as e:
         logger.error(f"Error in fuzzy file matching: {e}")
-        return None
+        return [None] * len(filenames)
+
+def find_best_match(filename, file_list):
+    """Find the best matching file from a pre-scanned file list using fuzzy matching"""
+    return find_best_matches([filename], file_list)[0]
 
 def find_closest_file(filename, files_directory="public/files/"):
     """Find the closest matching file in the files directory using fuzzy matching (legacy function)"""
     file_list = scan_files_directory(files_directory)
     return find_best_match(filename, file_list)
 
-def extract_markdown_links(text):
-    """Extract markdown links from text and return filename-link pairs"""
-    # Regex pattern for markdown links: [text](url)
-    pattern = r'\[([^\]]+)\]\(([^)]+)\)'
-    matches = re.findall(pattern, text)
-    
-    if not matches:
-        return []
-    
-    # Scan files directory once for all links
-    file_list = scan_files_directory()
+_unquote_cache = {}
+
+def _unquote(text):
+    """Decode percent-encoded characters, memoizing results across links"""
+    decoded = _unquote_cache.get(text)
+    if decoded is None:
+        if len(_unquote_cache) >= _UNQUOTE_CACHE_SIZE:
+            _unquote_cache.clear()
+        decoded = _unquote_cache[text] = unquote(text)
+    return decoded
+
+def _escape_html(text):
+    """Escape HTML special characters to prevent malformed display"""
+    return text.translate(_HTML_ESCAPE)
+
+def _is_web_url(url):
+    """Check whether a link points to the web rather than a local file"""
+    return url.startswith(("http://", "https://"))
+
+def _iter_markdown_links(text, start=0):
+    """Yield (start, end, text, url) for each markdown link [text](url) from start onwards"""
+    # Forward scan with str.find that matches exactly what the regex \[([^\]]+)\]\(([^)]+)\) would
+    pos = start
+    while True:
+        bracket_paren = text.find('](', pos)
+        if bracket_paren == -1:
+            return
+        close_paren = text.find(')', bracket_paren + 2)
+        if close_paren == -1:
+            return
+        # Link text can't contain ']', so the link opens at the first '[' after the previous ']'
+        previous_bracket = text.rfind(']', pos, bracket_paren)
+        open_bracket = text.find('[', previous_bracket + 1 if previous_bracket != -1 else pos, bracket_paren)
+        if open_bracket == -1 or open_bracket + 1 == bracket_paren or close_paren == bracket_paren + 2:
+            # No opening bracket, empty link text or empty url
+            pos = bracket_paren + 1
+            continue
+        yield open_bracket, close_paren + 1, text[open_bracket + 1:bracket_paren], text[bracket_paren + 2:close_paren]
+        pos = close_paren + 1
+
+def _replace_markdown_links(text, replace):
+    """Return text with each markdown link replaced by replace(original_link, url), in a single pass"""
+    parts = []
+    end = 0
+    for link_start, link_end, _, url in _iter_markdown_links(text):
+        parts.append(text[end:link_start])
+        parts.append(replace(text[link_start:link_end], url))
+        end = link_end
+    parts.append(text[end:])
+    return "".join(parts)
+
+def _next_link_start(text, end):
+    """Offset where an unfinished link could start; a found link can't change as more text arrives"""
+    next_start = text.find('[', end)
+    return next_start if next_start != -1 else len(text)
+
+def collect_markdown_links(text, start, links_info, get_file_list):
+    """Append info for complete markdown links found from start onwards and return the next scan offset
+
+    get_file_list is called for the scanned file list only when there are links to match.
+    """
+    # Skip scanning entirely when the rest of the text cannot contain a link
+    if text.find('](', start) == -1:
+        return _next_link_start(text, start)
     
-    links_info = []
-    for link_text, url in matches:
+    end = start
+    links = []
+    for _, end, link_text, url in _iter_markdown_links(text, start):
+        
         # Skip http/https links
-        if url.startswith("http://") or url.startswith("https://"):
+        if _is_web_url(url):
             continue
 
         # Extract filename from URL or use link text
@@ -101,11 +283,15 @@ def extract_markdown_links(text):
             filename = link_text
         
         # Decode percent-encoded characters in filename (like %20 -> space)
-        filename = unquote(filename)
-        
-        # Try to find a matching file using the pre-scanned file list
-        matched_filepath = find_best_match(filename, file_list)
-        
+        links.append((link_text, url, _unquote(filename)))
+    
+    if not links:
+        return _next_link_start(text, end)
+    
+    # Match all links against the scanned files in one batch
+    matched_filepaths = find_best_matches([filename for _, _, filename in links], get_file_list())
+    
+    for (link_text, url, filename), matched_filepath in zip(links, matched_filepaths):
         # Use the matched filepath if found, otherwise keep the original URL
         final_url = f"/gradio_api/file={matched_filepath}" if matched_filepath else url
         
@@ -117,14 +303,20 @@ def extract_markdown_links(text):
             'fuzzy_matched': matched_filepath is not None
         })
     
+    return _next_link_start(text, end)
+
+def extract_markdown_links(text):
+    """Extract markdown links from text and return filename-link pairs"""
+    links_info = []
+    collect_markdown_links(text, 0, links_info, scan_files_directory)
     return links_info
 
 def user(user_message, history):
     """Add user message to history immediately"""
     return "", history + [{"role": "user", "content": user_message}]
 
-async def bot(history):
-    """Stream bot response using async Azure client"""
+async def bot(history, thread_id):
+    """Stream bot response using async Azure client, reusing the session's conversation thread"""
     user_message = history[-1]["content"]
     
     # Add empty assistant message to history
@@ -134,56 +326,77 @@ async def bot(history):
         logger.info(f"Sending message to Azure agent: {user_message}")
         
         # Use the async streaming function directly
-        from src.azure import send_message_to_agent_streaming
+        from src.azure import create_new_conversation_async, send_message_to_agent_streaming
+        
+        # Refresh the file scan in a worker thread while the agent request is in flight
+        scan_task = asyncio.create_task(asyncio.to_thread(scan_files_directory))
         
-        # Stream the response from Azure
-        async for chunk in send_message_to_agent_streaming(user_message):
-            history[-1]["content"] += chunk
-            yield history
+        # Create the session's conversation thread on its first message only
+        if thread_id is None:
+            thread_id = await create_new_conversation_async()
         
-        # After streaming is complete, check for markdown links
-        final_message = history[-1]["content"]
-        links_info = extract_markdown_links(final_message)
+        # Stream the response from Azure, resolving markdown links as soon as they are complete
+        # (once the scan has finished, so link matching never waits on the filesystem)
+        links_info = []
+        scan_offset = 0
+        # Chunks are buffered in a list; appending to the message string would copy it every time
+        parts = []
+        shown_parts = 0
+        async for chunk in send_message_to_agent_streaming(user_message, thread_id=thread_id):
+            parts.append(chunk)
+            # Rebuild the message only every few chunks or at a word boundary
+            if len(parts) % _STREAM_REFRESH_CHUNKS and not chunk[-1:].isspace():
+                continue
+            history[-1]["content"] = "".join(parts)
+            shown_parts = len(parts)
+            if scan_task.done():
+                scan_offset = collect_markdown_links(history[-1]["content"], scan_offset, links_info, scan_task.result)
+            yield history, thread_id
+        
+        # After streaming is complete, show any buffered chunks and resolve any links that are left
+        final_message = history[-1]["content"] = "".join(parts)
+        await scan_task
+        collect_markdown_links(final_message, scan_offset, links_info, scan_task.result)
+        if shown_parts < len(parts) and not links_info:
+            yield history, thread_id
         
         if links_info:
             logger.info(f"Found {len(links_info)} links to process")
             
-            # Replace original markdown links with anchor links
-            updated_message = final_message
-            for i, link_info in enumerate(links_info):
-                # Create unique anchor ID for each card
-                anchor_id = f"source-card-{i}"
-                # Replace the markdown link with an anchor link that scrolls to the card
-                original_link = link_info['original_link']
-                anchor_link = f'<a href="#{anchor_id}" onclick="document.getElementById(\'{anchor_id}\').scrollIntoView({{behavior: \'smooth\'}}); return false;">{html.escape(link_info["text"])}</a>'
-                updated_message = updated_message.replace(original_link, anchor_link, 1)
-                logger.info(f"Replaced link {i}: {original_link}")
+            # Anchor links that scroll to each card, in the same order as the links
+            anchor_links = iter([
+                _ANCHOR_LINK_TEMPLATE % (i, i, _escape_html(link_info['text']))
+                for i, link_info in enumerate(links_info)
+            ])
+            
+            def replace_link(original_link, url):
+                # Web links have no card, so leave them as they are
+                if _is_web_url(url):
+                    return original_link
+                return next(anchor_links, original_link)
             
-            # Create individual source cards HTML - build as one complete string
-            cards_components = []
-            for i, link_info in enumerate(links_info):
-                # Escape HTML content to prevent malformed display
-                escaped_filename = html.escape(link_info['filename'])
-                escaped_url = html.escape(link_info['url'])
-                anchor_id = f"source-card-{i}"
-                
-                card_html = f'<div class="source-card" id="{anchor_id}"><div class="card-icon">📄</div><div class="card-title">{escaped_filename}</div><a href="{escaped_url}" class="card-link" target="_blank">Download</a></div>'
-                cards_components.append(card_html)
-                logger.info(f"Created card {i}: {escaped_filename}")
+            # Replace original markdown links with anchor links in a single pass
+            updated_message = _replace_markdown_links(final_message, replace_link)
             
-            # Join all cards into the container
-            cards_html = f'\n\n<div class="source-cards-container">{"".join(cards_components)}</div>'
+            # Create individual source cards HTML, escaping content to prevent malformed display
+            cards_html = '\n\n<div class="source-cards-container">' + "".join(
+                _SOURCE_CARD_TEMPLATE % (i, _escape_html(link_info['filename']), _escape_html(link_info['url']))
+                for i, link_info in enumerate(links_info)
+            ) + '</div>'
+            if logger.isEnabledFor(logging.DEBUG):
+                for i, link_info in enumerate(links_info):
+                    logger.debug(f"Created card {i}: {link_info['filename']}")
             logger.info(f"Final cards HTML length: {len(cards_html)}")
             
             # Update the message content with replaced links and append source cards
             history[-1]["content"] = updated_message + cards_html
-            yield history
+            yield history, thread_id
         
     except Exception as e:
         logger.error(f"Error communicating with Azure agent: {e}")
         error_msg = "Sorry, I encountered an error while processing your request. Please try again."
         history[-1]["content"] = error_msg
-        yield history
+        yield history, thread_id
 
 gr.set_static_paths(paths=["public/files/"])
 
@@ -283,10 +496,13 @@ html {
         container=False,
         max_lines=3
     )
+    
+    # Azure conversation thread ID for this browser session
+    thread_id = gr.State(None)
         
     # Connect the input to the response function using chained events
     msg.submit(user, [msg, chatbot], [msg, chatbot], queue=False).then(
-        bot, chatbot, chatbot
+        bot, [chatbot, thread_id], [chatbot, thread_id]
     )
 
 if __name__ == "__main__":
@@ -5,8 +5,9 @@ Provides high-level functions for interacting with Azure AI Agents.
 
 from azure.ai.projects.aio import AIProjectClient
 from azure.identity.aio import DefaultAzureCredential
-from azure.ai.agents.models import ListSortOrder
+from azure.ai.agents.models import AgentStreamEvent, ListSortOrder, MessageDeltaChunk, ThreadRun
 from typing import List, Dict, Optional, AsyncGenerator
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,18 +36,22 @@ class AzureAgentClient:
         # Store active thread
         self.current_thread = None
         
-        # We'll get the agent lazily
+        # We'll get the agent lazily, fetching it only once under concurrent first requests
         self._agent = None
+        self._agent_lock = asyncio.Lock()
     
     async def _get_agent(self):
         """Get the agent asynchronously, caching the result."""
-        if self._agent is None:
-            try:
-                self._agent = await self.project.agents.get_agent(self.agent_id)
-                logger.info(f"Successfully connected to agent: {self.agent_id}")
-            except Exception as e:
-                logger.error(f"Failed to connect to agent {self.agent_id}: {e}")
-                raise
+        if self._agent is not None:
+            return self._agent
+        async with self._agent_lock:
+            if self._agent is None:
+                try:
+                    self._agent = await self.project.agents.get_agent(self.agent_id)
+                    logger.info(f"Successfully connected to agent: {self.agent_id}")
+                except Exception as e:
+                    logger.error(f"Failed to connect to agent {self.agent_id}: {e}")
+                    raise
         return self._agent
     
     async def create_new_conversation(self) -> str:
@@ -118,17 +123,18 @@ class AzureAgentClient:
                     "response": "Sorry, I encountered an error while processing your request."
                 }
             
-            # Get the response messages
+            # Get the response messages, newest first
             messages = self.project.agents.messages.list(
                 thread_id=target_thread_id, 
-                order=ListSortOrder.ASCENDING
+                order=ListSortOrder.DESCENDING
             )
             
-            # Find the latest assistant response
+            # Find the latest assistant response; stopping early avoids paging through the thread
             latest_response = None
             async for msg in messages:
                 if msg.role == "assistant" and msg.text_messages:
                     latest_response = msg.text_messages[-1].text.value
+                    break
             
             if latest_response:
                 logger.info("Successfully got agent response")
@@ -227,33 +233,30 @@ class AzureAgentClient:
             # Get the agent
             agent = await self._get_agent()
             
-            # Use the async create_and_process method which handles the run lifecycle
-            run = await self.project.agents.runs.create_and_process(
+            # Stream the run and yield text deltas as the agent produces them
+            received_response = False
+            async with await self.project.agents.runs.stream(
                 thread_id=target_thread_id,
                 agent_id=agent.id
-            )
-            
-            if run.status == "failed":
-                error_msg = f"Sorry, I encountered an error while processing your request: {run.last_error}"
-                logger.error(f"Agent run failed: {run.last_error}")
-                yield error_msg
-                return
-            
-            # Get the response messages
-            messages = self.project.agents.messages.list(
-                thread_id=target_thread_id, 
-                order=ListSortOrder.ASCENDING
-            )
+            ) as stream:
+                async for event_type, event_data, _ in stream:
+                    if isinstance(event_data, MessageDeltaChunk):
+                        if event_data.text:
+                            received_response = True
+                            yield event_data.text
+                    elif isinstance(event_data, ThreadRun) and event_data.status == "failed":
+                        error_msg = f"Sorry, I encountered an error while processing your request: {event_data.last_error}"
+                        logger.error(f"Agent run failed: {event_data.last_error}")
+                        yield error_msg
+                        return
+                    elif event_type == AgentStreamEvent.ERROR:
+                        error_msg = f"Sorry, I encountered an error while processing your request: {event_data}"
+                        logger.error(f"Agent stream error: {event_data}")
+                        yield error_msg
+                        return
             
-            # Find the latest assistant response
-            latest_response = None
-            async for msg in messages:
-                if msg.role == "assistant" and msg.text_messages:
-                    latest_response = msg.text_messages[-1].text.value
-            
-            if latest_response:
-                logger.info("Successfully got agent response, streaming...")
-                yield latest_response
+            if received_response:
+                logger.info("Successfully streamed agent response")
             else:
                 error_msg = "I'm sorry, I didn't receive a proper response. Please try again."
                 yield error_msg
@@ -270,26 +273,31 @@ DEFAULT_AGENT_ID = "asst_Npta2BcwtSASqC4SLTHSsQUZ"
 
 # Global client instance
 _client = None
+_client_lock = asyncio.Lock()
 
 async def get_azure_client() -> AzureAgentClient:
     """Get or create the global Azure client instance."""
     global _client
-    if _client is None:
-        _client = AzureAgentClient(DEFAULT_ENDPOINT, DEFAULT_AGENT_ID)
+    if _client is not None:
+        return _client
+    async with _client_lock:
+        if _client is None:
+            _client = AzureAgentClient(DEFAULT_ENDPOINT, DEFAULT_AGENT_ID)
     return _client
 
-async def send_message_to_agent_async(content: str) -> str:
+async def send_message_to_agent_async(content: str, thread_id: Optional[str] = None) -> str:
     """
     Async function to send a message to the Azure agent.
     
     Args:
         content: Message to send
+        thread_id: Optional thread ID. If not provided, uses the client's current thread.
     
     Returns:
         Agent's response as a string
     """
     client = await get_azure_client()
-    result = await client.send_message(content)
+    result = await client.send_message(content, thread_id=thread_id)
     return result["response"]
 
 async def create_new_conversation_async() -> str:
@@ -297,16 +305,17 @@ async def create_new_conversation_async() -> str:
     client = await get_azure_client()
     return await client.create_new_conversation()
 
-async def send_message_to_agent_streaming(content: str) -> AsyncGenerator[str, None]:
+async def send_message_to_agent_streaming(content: str, thread_id: Optional[str] = None) -> AsyncGenerator[str, None]:
     """
     Simple async function to send a message to the Azure agent and stream the response.
     
     Args:
         content: Message to send
+        thread_id: Optional thread ID. If not provided, uses the client's current thread.
     
     Yields:
         Chunks of the agent's response as they become available
     """
     client = await get_azure_client()
-    async for chunk in client.send_message_streaming(content):
+    async for chunk in client.send_message_streaming(content, thread_id=thread_id):
         yield chunk